@@ -0,0 +1,41 @@
+"""
+Ahead-of-time build of the VehiclePIDController step kernel, so the first control step does not pay the numba
+JIT (or cache load) latency. Run once after installation, and again whenever _pid_step changes:
+
+    python -m ISS.algorithms.control.pid_wpt_kernel_build
+
+This writes the pid_wpt_kernel extension module next to pid_wpt_tracker.py, which picks it up on import and
+falls back to the JIT kernel when it is missing or was built for another PID_KERNEL_VERSION.
+"""
+import os
+from numba.pycc import CC
+
+from ISS.algorithms.control.pid_wpt_tracker import PID_KERNEL_VERSION, _pid_step
+
+PID_STATE = "Tuple((int64, int64, float64, float64))"
+PID_GAINS = "UniTuple(float64, 7)"
+PID_STEP_SIGNATURE = (
+    "Tuple((float64, float64, float64, int64, {state}, {state}, float64))"
+    "(float32[:, ::1], float32[::1], float64[::1], int64, boolean, "
+    "float64, float64, float64, float64, float64, float64, float64, boolean, float64, "
+    "float32[::1], {state}, {gains}, float32[::1], {state}, {gains})"
+).format(state=PID_STATE, gains=PID_GAINS)
+
+cc = CC("pid_wpt_kernel")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+@cc.export("version", "int64()")
+def version():
+    return PID_KERNEL_VERSION
+
+
+@cc.export("pid_step", PID_STEP_SIGNATURE)
+def pid_step(traj_xy, traj_v, traj_len, index, relocate, x, y, ch, sh, speed, look_ahead, look_ahead_sq,
+             lost_track, lost_track_sq, lon_buf, lon_state, lon_gains, lat_buf, lat_state, lat_gains):
+    return _pid_step(traj_xy, traj_v, traj_len, index, relocate, x, y, ch, sh, speed, look_ahead, look_ahead_sq,
+                     lost_track, lost_track_sq, lon_buf, lon_state, lon_gains, lat_buf, lat_state, lat_gains)
+
+
+if __name__ == "__main__":
+    cc.compile()
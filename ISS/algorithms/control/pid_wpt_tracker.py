@@ -1,9 +1,169 @@
 import math
 import numpy as np
-from collections import deque
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, the kernels below then run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# number of past errors kept for the integral term
+ERROR_BUFFER_SIZE = 10
+# bump whenever the _pid_step signature or semantics change, so a stale AOT build is ignored
+PID_KERNEL_VERSION = 7
+
+@njit(cache=True)
+def _clip(x, lo, hi):
+    return lo if x < lo else hi if x > hi else x
+
+@njit(cache=True)
+def _pid_update(buf, state, error, gains):
+    """
+    One PID update on a ring buffer of past errors.
+
+    :param buf: ring buffer of the last ERROR_BUFFER_SIZE errors, updated in place
+    :param state: (head, count, error_sum, prev_error) of the ring buffer
+    :param error: current error
+    :param gains: (K_P, K_I, K_D, dt, 1 / dt, output_min, output_max)
+    :return: clipped control output and the new state
+    """
+    head, count, total, prev = state
+    k_p, k_i, k_d, dt, inv_dt, output_min, output_max = gains
+    if count == buf.shape[0]:
+        total -= float(buf[head])
+    else:
+        count += 1
+    # accumulate the stored float32 value, which is also what is later evicted, so the running sum only
+    # picks up float64 rounding, not float32 truncation, and its drift stays small
+    buf[head] = error
+    total += float(buf[head])
+    head = (head + 1) % buf.shape[0]
+
+    if count >= 2:
+        _de = (error - prev) * inv_dt
+        _ie = total * dt
+    else:
+        _de = 0.0
+        _ie = 0.0
+    output = _clip((k_p * error) + (k_d * _de) + (k_i * _ie), output_min, output_max)
+    return output, (head, count, total, error)
+
+@njit(cache=True)
+def _lateral_error(x, y, ch, sh, waypoint_x, waypoint_y):
+    """
+    Signed angle between the vehicle heading and the vector to the waypoint, shared by the fused tracker kernel
+    and PIDLateralController.
+
+    :param ch: cosine of the vehicle heading
+    :param sh: sine of the vehicle heading
+    :return: lateral error in radians, positive when the waypoint is to the left
+    """
+    # atan2(cross_z, dot) gives the sign directly without normalising either vector
+    wx = waypoint_x - x
+    wy = waypoint_y - y
+    return math.atan2(ch * wy - sh * wx, ch * wx + sh * wy)
+
+@njit(cache=True)
+def _relocate(traj_xy, traj_len, x, y, look_ahead):
+    """
+    Find the waypoint one look-ahead distance of arc length past the waypoint nearest to (x, y).
+
+    :param traj_len: cumulative arc length of the trajectory at each waypoint
+    :return: waypoint index
+    """
+    nearest = 0
+    dx = x - traj_xy[0, 0]
+    dy = y - traj_xy[0, 1]
+    nearest_d2 = dx * dx + dy * dy
+    for i in range(1, traj_xy.shape[0]):
+        dx = x - traj_xy[i, 0]
+        dy = y - traj_xy[i, 1]
+        d2 = dx * dx + dy * dy
+        if d2 < nearest_d2:
+            nearest = i
+            nearest_d2 = d2
+    index = np.searchsorted(traj_len, traj_len[nearest] + look_ahead)
+    return min(index, traj_xy.shape[0] - 1)
+
+@njit(cache=True)
+def _pid_step(traj_xy, traj_v, traj_len, index, relocate, x, y, ch, sh, speed, look_ahead, look_ahead_sq,
+              lost_track, lost_track_sq, lon_buf, lon_state, lon_gains, lat_buf, lat_state, lat_gains):
+    """
+    Fused VehiclePIDController step: look-ahead search followed by the longitudinal and lateral PID updates.
+
+    :param relocate: search the whole trajectory for the starting waypoint instead of continuing from index
+    :param lost_track: also relocate when the waypoint at index is farther than sqrt(lost_track_sq)
+    :return: throttle, steering, target speed, selected waypoint index, new longitudinal and lateral states
+             and the lateral error
+    """
+    dx = x - traj_xy[index, 0]
+    dy = y - traj_xy[index, 1]
+    if relocate or (lost_track and dx * dx + dy * dy > lost_track_sq):
+        index = _relocate(traj_xy, traj_len, x, y, look_ahead)
+
+    # advance to the first remaining waypoint outside the look-ahead radius,
+    # or to the last waypoint if all of them are within it
+    last = traj_xy.shape[0] - 1
+    while index < last:
+        dx = x - traj_xy[index, 0]
+        dy = y - traj_xy[index, 1]
+        if dx * dx + dy * dy > look_ahead_sq:
+            break
+        index += 1
+    target_speed = float(traj_v[index])
+    throttle, lon_state = _pid_update(lon_buf, lon_state, target_speed - speed, lon_gains)
+
+    lat_error = _lateral_error(x, y, ch, sh, float(traj_xy[index, 0]), float(traj_xy[index, 1]))
+    steering, lat_state = _pid_update(lat_buf, lat_state, lat_error, lat_gains)
+    return throttle, steering, target_speed, index, lon_state, lat_state, lat_error
+
+@njit(cache=True)
+def _pid_rollout(traj_xy, traj_v, traj_len, index, relocate, states, ch, sh, look_ahead, look_ahead_sq,
+                 lost_track, lost_track_sq, lon_buf, lon_state, lon_gains, lat_buf, lat_state, lat_gains):
+    """
+    Run _pid_step over a sequence of vehicle states, as consecutive VehiclePIDController.run_step calls would.
+
+    :return: throttles, steerings and target speeds, zero for the states after the end of the trajectory
+    """
+    n = states.shape[0]
+    throttles = np.zeros(n)
+    steerings = np.zeros(n)
+    target_speeds = np.zeros(n)
+    last = traj_xy.shape[0] - 1
+    for i in range(n):
+        if index >= last:
+            break
+        throttle, steering, target_speed, index, lon_state, lat_state, _ = _pid_step(
+            traj_xy, traj_v, traj_len, index, relocate, states[i, 0], states[i, 1], ch[i], sh[i], states[i, 3],
+            look_ahead, look_ahead_sq, lost_track, lost_track_sq,
+            lon_buf, lon_state, lon_gains, lat_buf, lat_state, lat_gains)
+        relocate = False
+        throttles[i] = throttle
+        steerings[i] = steering
+        target_speeds[i] = target_speed
+    return throttles, steerings, target_speeds
+
+def _select_pid_step_kernel():
+    """
+    Prefer the ahead-of-time compiled kernel built by pid_wpt_kernel_build, it needs no JIT on the first step.
+    Fall back to the JIT _pid_step when it is missing or was built for another PID_KERNEL_VERSION.
+    """
+    try:
+        from ISS.algorithms.control import pid_wpt_kernel
+    except ImportError:
+        return _pid_step
+    if pid_wpt_kernel.version() != PID_KERNEL_VERSION:
+        return _pid_step
+    return pid_wpt_kernel.pid_step
+
+_pid_step_kernel = _select_pid_step_kernel()
 
 def euclidean_distance(v1, v2):
-    return math.sqrt(sum([(a - b) ** 2 for a, b in zip(v1, v2)]))
+    if len(v1) == 2 and len(v2) == 2:
+        return math.hypot(v1[0] - v2[0], v1[1] - v2[1])
+    return math.hypot(*(a - b for a, b in zip(v1, v2)))
 
 class VehiclePIDController:
     """
@@ -11,7 +171,7 @@ class VehiclePIDController:
     low level control a vehicle from client side
     """
 
-    def __init__(self, args_lateral=None, args_longitudinal=None, look_ahead=1):
+    def __init__(self, args_lateral=None, args_longitudinal=None, look_ahead=1, lost_track_distance=None):
         """        
         :param args_lateral: dictionary of arguments to set the lateral PID controller using the following semantics:
                              K_P -- Proportional term
@@ -22,26 +182,45 @@ class VehiclePIDController:
                              K_P -- Proportional term
                              K_D -- Differential term
                              K_I -- Integral term
+        :param look_ahead: distance (in meters) of the tracked waypoint ahead of the vehicle
+        :param lost_track_distance: distance (in meters) to the tracked waypoint beyond which it is searched for again
+                                    over the whole trajectory, disabled by default. Each search is O(len(traj)),
+                                    so keep it well above the waypoint spacing plus look_ahead
         """
         if not args_lateral:            
             args_lateral = {'K_P': 2, 'K_I': 0., 'K_D': 0.2, "output_max": 1, "output_min": -1, "dt": 0.1}
         if not args_longitudinal:            
             args_longitudinal = {'K_P': 2, 'K_I': 0., 'K_D': 0.1, "output_max": 1, "output_min": 0, "dt": 0.1}
         self._look_ahead = look_ahead
+        self._look_ahead_sq = look_ahead ** 2
+        self._lost_track = lost_track_distance is not None
+        self._lost_track_sq = lost_track_distance ** 2 if self._lost_track else 0.0
         self._lon_controller = PIDLongitudinalController(**args_longitudinal)
         self._lat_controller = PIDLateralController(**args_lateral)        
-        self.traj = []
         self.goal = None
-        self.waypoint_index = 0
+        self._heading = None
+        self._heading_cs = (1.0, 0.0)
+        self.set_traj([])
 
     def reset(self):
-        self.traj.clear()
-        self.waypoint_index = 0
+        self.set_traj([])
         self._lon_controller.reset()
         self._lat_controller.reset()    
     
     def set_traj(self, traj):
-        self.traj = traj
+        # rows are [x, y, heading_angle, velocity, ...], stored contiguously so the
+        # look-ahead search reads plain floats instead of boxed per-point tuples,
+        # float32 is plenty for tracking and halves the memory the search streams through
+        if len(traj) == 0:
+            self.traj = np.zeros((0, 4), dtype=np.float32)
+        else:
+            self.traj = np.ascontiguousarray(traj, dtype=np.float32)
+        self._traj_xy = np.ascontiguousarray(self.traj[:, :2])
+        self._traj_v = np.ascontiguousarray(self.traj[:, 3])
+        # cumulative arc length, lets the first step after a new trajectory jump straight to the look-ahead point
+        seg_len = np.hypot(*np.diff(self._traj_xy.astype(np.float64), axis=0).T)
+        self._traj_len = np.concatenate(([0.0], np.cumsum(seg_len)))
+        self._relocate = True
         self.waypoint_index = 0
 
     def run_step(self, vehicle_location, thro_as_speed=False):
@@ -58,21 +237,46 @@ class VehiclePIDController:
         
         current_location = (vehicle_location.x, vehicle_location.y, vehicle_location.heading_angle)
         current_speed = vehicle_location.velocity
-        
-        while self.waypoint_index < len(self.traj) - 1:
-            traj_point = self.traj[self.waypoint_index]
-            v_vec = (current_location[0] - traj_point[0], current_location[1] - traj_point[1])
-            if np.linalg.norm(v_vec) > self._look_ahead:
-                break
-            self.waypoint_index += 1
-        traj_point = self.traj[self.waypoint_index]
-        target_speed = self.traj[self.waypoint_index][3]
-        throttle = self._lon_controller.run_step(current_speed, target_speed)
-        steering = self._lat_controller.run_step(current_location, traj_point)
-        self.waypoint_index += 1
+        if current_location[2] != self._heading:
+            self._heading = current_location[2]
+            self._heading_cs = (math.cos(self._heading), math.sin(self._heading))
+        ch, sh = self._heading_cs
+
+        lon = self._lon_controller
+        lat = self._lat_controller
+        throttle, steering, target_speed, self.waypoint_index, lon._error_state, lat._e_state, lat_error = _pid_step_kernel(
+            self._traj_xy, self._traj_v, self._traj_len, self.waypoint_index, self._relocate,
+            current_location[0], current_location[1], ch, sh, current_speed, self._look_ahead, self._look_ahead_sq,
+            self._lost_track, self._lost_track_sq,
+            lon._error_buffer, lon._error_state, lon._gains, lat._e_buffer, lat._e_state, lat._gains)
+        self._relocate = False
+        lat.log_lat_error(lat_error)
         if thro_as_speed:
             throttle = target_speed
         return throttle, steering
+
+    def run_rollout(self, vehicle_states, thro_as_speed=False):
+        """
+        Evaluate run_step over a whole sequence of vehicle states in one call, e.g. to warm start a planner.
+        The controller itself is left untouched, the rollout starts from the current waypoint and PID states.
+
+        :param vehicle_states: array of shape (N, k), k >= 4, with rows [x, y, heading_angle, velocity, ...]
+        :return: arrays of N throttles and N steerings
+        """
+        states = np.asarray(vehicle_states, dtype=np.float64)
+        if states.ndim != 2 or states.shape[1] < 4:
+            raise ValueError("vehicle_states must have shape (N, k) with k >= 4, got {}".format(states.shape))
+        states = np.ascontiguousarray(states[:, :4])
+        lon = self._lon_controller
+        lat = self._lat_controller
+        throttles, steerings, target_speeds = _pid_rollout(
+            self._traj_xy, self._traj_v, self._traj_len, self.waypoint_index, self._relocate,
+            states, np.cos(states[:, 2]), np.sin(states[:, 2]), self._look_ahead, self._look_ahead_sq,
+            self._lost_track, self._lost_track_sq,
+            lon._error_buffer.copy(), lon._error_state, lon._gains, lat._e_buffer.copy(), lat._e_state, lat._gains)
+        if thro_as_speed:
+            throttles = target_speeds
+        return throttles, steerings
     
 
 
@@ -97,10 +301,18 @@ class PIDLongitudinalController:
 
         ## To-DO _dt is not determined in asynchronomous mode
         self._dt = dt        
-        self._error_buffer = deque(maxlen=10)        
+        self._update_gains()
+        self.reset()
+
+    def _update_gains(self):
+        self._inv_dt = 1.0 / self._dt
+        self._gains = (float(self._K_P), float(self._K_I), float(self._K_D), float(self._dt), self._inv_dt,
+                       float(self._output_min), float(self._output_max))
 
     def reset(self):
-        self._error_buffer = deque(maxlen=10)
+        # ring buffer of the last ERROR_BUFFER_SIZE errors, state is (head, count, error_sum, prev_error)
+        self._error_buffer = np.zeros(ERROR_BUFFER_SIZE, dtype=np.float32)
+        self._error_state = (0, 0, 0.0, 0.0)
 
     def run_step(self, current_speed, target_speed):
         """
@@ -119,16 +331,9 @@ class PIDLongitudinalController:
         :param current_speed: current speed of the vehicle in m/s
         :return: throttle control in the range [0, 1]
         """
-        error = (target_speed - current_speed)
-        self._error_buffer.append(error)        
-
-        if len(self._error_buffer) >= 2:
-            _de = (self._error_buffer[-1] - self._error_buffer[-2]) / self._dt
-            _ie = sum(self._error_buffer) * self._dt
-        else:
-            _de = 0.0
-            _ie = 0.0
-        return np.clip((self._K_P * error) + (self._K_D * _de) + (self._K_I * _ie), self._output_min, self._output_max)
+        error = float(target_speed - current_speed)
+        throttle, self._error_state = _pid_update(self._error_buffer, self._error_state, error, self._gains)
+        return throttle
 
     def change_parameters(self, K_P, K_I, K_D, dt):
         """Changes the PID parameters"""
@@ -136,6 +341,7 @@ class PIDLongitudinalController:
         self._K_I = K_I
         self._K_D = K_D
         self._dt = dt
+        self._update_gains()
 
 class PIDLateralController:
     """
@@ -156,50 +362,62 @@ class PIDLateralController:
         self._output_min = output_min
         ## To-DO _dt is not determined in asynchronomous mode
         self._dt = dt    
-        self._e_buffer = deque(maxlen=10)        
-        self.lat_error = []
+        self._update_gains()
+        self.reset()
+        # lateral error log, grown by doubling so logging stays amortised O(1)
+        self._lat_error_log = np.empty(1024)
+        self._lat_n = 0
+
+    def _update_gains(self):
+        self._inv_dt = 1.0 / self._dt
+        self._gains = (float(self._K_P), float(self._K_I), float(self._K_D), float(self._dt), self._inv_dt,
+                       float(self._output_min), float(self._output_max))
+
+    @property
+    def lat_error(self):
+        """Lateral errors of all steps so far, as a view into the log"""
+        return self._lat_error_log[:self._lat_n]
+
+    def log_lat_error(self, error):
+        if self._lat_n == len(self._lat_error_log):
+            self._lat_error_log = np.resize(self._lat_error_log, 2 * self._lat_n)
+        self._lat_error_log[self._lat_n] = error
+        self._lat_n += 1
 
     def reset(self):
-        self._e_buffer = deque(maxlen=10)
+        # ring buffer of the last ERROR_BUFFER_SIZE errors, state is (head, count, error_sum, prev_error)
+        self._e_buffer = np.zeros(ERROR_BUFFER_SIZE, dtype=np.float32)
+        self._e_state = (0, 0, 0.0, 0.0)
 
-    def run_step(self, vehicle_location, waypoint):
+    def run_step(self, vehicle_location, waypoint, heading_cs=None):
         """
         Execute one step of lateral control to steer the vehicle towards a certain waypoin.
 
         :param waypoint: target waypoint
+        :param heading_cs: precomputed (cos, sin) of the vehicle heading, computed here if None
         :return: steering control in the range [-1, 1] where:
             +1 maximum steering to left
             -1 represent maximum steering to right
         """
-        return self._pid_control(vehicle_location, waypoint)
+        if heading_cs is None:
+            heading_cs = (math.cos(vehicle_location[2]), math.sin(vehicle_location[2]))
+        return self._pid_control(vehicle_location, heading_cs[0], heading_cs[1], waypoint)
 
-    def _pid_control(self, vehicle_location, waypoint):
+    def _pid_control(self, vehicle_location, ch, sh, waypoint):
         """
         Estimate the steering angle of the vehicle based on the PID equations
 
+        :param vehicle_location: current [x, y, ...] of the vehicle
+        :param ch: cosine of the vehicle heading
+        :param sh: sine of the vehicle heading
         :param waypoint: target waypoint [x, y]
-        :param vehicle_transform: current transform of the vehicle
         :return: steering control in the range [-1, 1]
         """        
-        v_vec = np.array([math.cos(vehicle_location[2]), math.sin(vehicle_location[2]), 0.0])        
-        w_vec = np.array([waypoint[0] - vehicle_location[0], waypoint[1] - vehicle_location[1], 0.0])
-        _dot = math.acos(np.clip(np.dot(w_vec, v_vec) /
-                                 (np.linalg.norm(w_vec) * np.linalg.norm(v_vec)), -1.0, 1.0))
-            
-        _cross = np.cross(v_vec, w_vec)
-        if _cross[2] < 0:
-            _dot *= -1.0
-        self._e_buffer.append(_dot)
-        self.lat_error.append(_dot)
-
-        if len(self._e_buffer) >= 2:
-            _de = (self._e_buffer[-1] - self._e_buffer[-2]) / self._dt
-            _ie = sum(self._e_buffer) * self._dt
-        else:
-            _de = 0.0
-            _ie = 0.0
+        _dot = _lateral_error(float(vehicle_location[0]), float(vehicle_location[1]), ch, sh,
+                              float(waypoint[0]), float(waypoint[1]))
+        self.log_lat_error(_dot)
 
-        steering_from_yaw = np.clip((self._K_P * _dot) + (self._K_D * _de) + (self._K_I * _ie), self._output_min, self._output_max) 
+        steering_from_yaw, self._e_state = _pid_update(self._e_buffer, self._e_state, _dot, self._gains)
         return steering_from_yaw
         
 
@@ -208,4 +426,5 @@ class PIDLateralController:
         self._K_P = K_P
         self._K_I = K_I
         self._K_D = K_D
-        self._dt = dt
\ No newline at end of file
+        self._dt = dt
+        self._update_gains()
\ No newline at end of file
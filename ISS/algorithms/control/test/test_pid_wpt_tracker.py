@@ -0,0 +1,233 @@
+import math
+import sys
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from ISS.algorithms.control import pid_wpt_tracker
+from ISS.algorithms.control.pid_wpt_tracker import (ERROR_BUFFER_SIZE, PIDLateralController,
+                                                    PIDLongitudinalController, VehiclePIDController)
+
+
+def _reference_pid(errors, K_P, K_I, K_D, dt, output_min, output_max):
+    # the original deque(maxlen=10) + sum() PID formulation
+    buffer = deque(maxlen=10)
+    outputs = []
+    for error in errors:
+        buffer.append(error)
+        if len(buffer) >= 2:
+            _de = (buffer[-1] - buffer[-2]) / dt
+            _ie = sum(buffer) * dt
+        else:
+            _de = 0.0
+            _ie = 0.0
+        outputs.append(min(max((K_P * error) + (K_D * _de) + (K_I * _ie), output_min), output_max))
+    return outputs
+
+
+def test_ring_buffer_matches_deque_reference():
+    rng = np.random.default_rng(3)
+    # well past ERROR_BUFFER_SIZE so errors are evicted from the ring buffer
+    targets = rng.normal(size=4 * ERROR_BUFFER_SIZE + 3) * 2.0
+    gains = dict(K_P=0.7, K_I=0.4, K_D=0.05, dt=0.1, output_min=-10.0, output_max=10.0)
+    controller = PIDLongitudinalController(**gains)
+    expected = _reference_pid(targets - 1.0, **gains)
+    for target, reference in zip(targets, expected):
+        # the buffer stores float32 errors
+        assert math.isclose(controller.run_step(1.0, target), reference, rel_tol=1e-6, abs_tol=1e-6)
+
+
+def _reference_lateral_error(vehicle_location, waypoint):
+    # the original acos(clip(...)) formulation with the cross product sign fix
+    v_vec = np.array([math.cos(vehicle_location[2]), math.sin(vehicle_location[2]), 0.0])
+    w_vec = np.array([waypoint[0] - vehicle_location[0], waypoint[1] - vehicle_location[1], 0.0])
+    _dot = math.acos(np.clip(np.dot(w_vec, v_vec) / (np.linalg.norm(w_vec) * np.linalg.norm(v_vec)), -1.0, 1.0))
+    if np.cross(v_vec, w_vec)[2] < 0:
+        _dot *= -1.0
+    return _dot
+
+
+def test_lateral_error_matches_acos_reference():
+    controller = PIDLateralController()
+    cases = [
+        ((0.0, 0.0, 0.0), (1.0, 1.0)),  # left of the heading
+        ((0.0, 0.0, 0.0), (1.0, -1.0)),  # right of the heading
+        ((0.0, 0.0, 0.0), (-1.0, 0.5)),  # behind, to the left
+        ((0.0, 0.0, 0.0), (-1.0, -0.5)),  # behind, to the right
+        ((0.0, 0.0, 0.0), (2.0, 1e-4)),  # almost straight ahead
+        ((1.0, 2.0, 2.5), (-3.0, 1.0)),
+        ((1.0, 2.0, -2.0), (0.0, -5.0)),
+    ]
+    for vehicle_location, waypoint in cases:
+        controller.run_step(vehicle_location, waypoint)
+        expected = _reference_lateral_error(vehicle_location, waypoint)
+        # acos loses precision near zero, hence the absolute tolerance
+        assert math.isclose(controller.lat_error[-1], expected, abs_tol=1e-7)
+    assert controller.lat_error[0] > 0
+    assert controller.lat_error[1] < 0
+
+
+def test_infinite_output_limits():
+    controller = PIDLongitudinalController(K_P=1, K_I=0, K_D=0, dt=0.1, output_max=float('inf'), output_min=0)
+    assert controller.run_step(0.0, 1.0) == 1.0
+    assert controller.run_step(0.0, 1e6) == 1e6
+
+    tracker = VehiclePIDController(args_longitudinal={'K_P': 1, 'K_I': 0., 'K_D': 0., "output_max": math.inf,
+                                                     "output_min": -math.inf, "dt": 0.1})
+    tracker.set_traj([[i * 0.1, 0.0, 0.0, 0.0] for i in range(100)])
+    throttle, _ = tracker.run_step(SimpleNamespace(x=0.0, y=0.0, heading_angle=0.0, velocity=2.0))
+    assert throttle == -2.0
+    tracker.set_traj([[i * 0.1, 0.0, 0.0, 1e6] for i in range(100)])
+    throttle, _ = tracker.run_step(SimpleNamespace(x=0.0, y=0.0, heading_angle=0.0, velocity=0.0))
+    assert throttle == 1e6
+
+
+def test_enabling_integral_uses_error_history():
+    controller = PIDLongitudinalController(K_P=1.0, K_I=0.0, K_D=0.0, output_max=10, output_min=-10, dt=0.1)
+    for _ in range(ERROR_BUFFER_SIZE):
+        controller.run_step(0.0, 0.5)
+    controller.change_parameters(K_P=1.0, K_I=1.0, K_D=0.0, dt=0.1)
+    # proportional 0.5 plus the integral over ten errors of 0.5
+    assert math.isclose(controller.run_step(0.0, 0.5), 0.5 + 1.0 * 10 * 0.5 * 0.1)
+
+
+def _make_tracker():
+    tracker = VehiclePIDController({'K_P': 2, 'K_I': 0.2, 'K_D': 0.2, "output_max": 1, "output_min": -1, "dt": 0.1},
+                                   None, look_ahead=1.5)
+    xs = np.linspace(0, 20, 400)
+    # rows laid out like Trajectory states: x, y, heading_angle, velocity, ... time_from_start
+    traj = np.zeros((len(xs), 9))
+    traj[:, 0] = xs
+    traj[:, 1] = 4 * np.sin(xs / 3)
+    traj[:, 3] = 5 + np.cos(xs)
+    traj[:, 8] = xs
+    tracker.set_traj(traj)
+    return tracker
+
+
+def test_rollout_matches_run_step():
+    rng = np.random.default_rng(1)
+    n = 300
+    xs = np.arange(n) * 0.05
+    states = np.zeros((n, 9))
+    states[:, 0] = xs + rng.normal(size=n) * 0.3
+    states[:, 1] = 4 * np.sin(xs / 3) + rng.normal(size=n) * 0.3
+    states[:, 2] = rng.normal(size=n) * 0.5
+    states[:, 3] = 4 + rng.normal(size=n)
+
+    tracker = _make_tracker()
+    throttles, steerings = tracker.run_rollout(states)
+    assert throttles.shape == steerings.shape == (n,)
+    for i, (x, y, heading_angle, velocity) in enumerate(states[:, :4]):
+        throttle, steering = tracker.run_step(SimpleNamespace(x=x, y=y, heading_angle=heading_angle,
+                                                              velocity=velocity))
+        assert math.isclose(throttle, throttles[i], abs_tol=1e-9)
+        assert math.isclose(steering, steerings[i], abs_tol=1e-9)
+
+
+def test_rollout_rejects_malformed_states():
+    tracker = _make_tracker()
+    for states in (np.zeros(8), np.zeros((8, 3)), np.zeros((2, 8, 4))):
+        with pytest.raises(ValueError):
+            tracker.run_rollout(states)
+
+
+def test_lost_track_relocation_is_opt_in():
+    traj = [[i * 0.1, 0.0, 0.0, 5.0] for i in range(1000)]
+    far_ahead = SimpleNamespace(x=50.0, y=0.5, heading_angle=0.0, velocity=3.0)
+    behind = SimpleNamespace(x=20.0, y=0.5, heading_angle=0.0, velocity=3.0)
+
+    tracker = VehiclePIDController(look_ahead=2.0)
+    tracker.set_traj(traj)
+    tracker.run_step(far_ahead)
+    # the first step after set_traj always starts from the nearest waypoint
+    assert tracker.waypoint_index == 520
+    tracker.run_step(behind)
+    assert tracker.waypoint_index == 520
+
+    tracker = VehiclePIDController(look_ahead=2.0, lost_track_distance=6.0)
+    tracker.set_traj(traj)
+    tracker.run_step(far_ahead)
+    tracker.run_step(behind)
+    assert tracker.waypoint_index == 220
+
+
+def test_tracker_propagates_nan_like_standalone_controllers():
+    traj = [[i * 0.1, 0.0, 0.0, 5.0] for i in range(100)]
+    nan_state = SimpleNamespace(x=0.0, y=0.1, heading_angle=0.0, velocity=math.nan)
+    for limits in ((0.0, 1.0), (-math.inf, math.inf)):
+        args = {'K_P': 2, 'K_I': 0., 'K_D': 0.1, "output_min": limits[0], "output_max": limits[1], "dt": 0.1}
+        tracker = VehiclePIDController(args_longitudinal=dict(args))
+        tracker.set_traj(traj)
+        throttle, _ = tracker.run_step(nan_state)
+        assert math.isnan(throttle)
+        assert math.isnan(PIDLongitudinalController(**args).run_step(math.nan, 5.0))
+
+
+def _fake_kernel_module(monkeypatch, version):
+    import ISS.algorithms.control as control
+    fake = SimpleNamespace(version=lambda: version, pid_step=object())
+    monkeypatch.setitem(sys.modules, 'ISS.algorithms.control.pid_wpt_kernel', fake)
+    monkeypatch.setattr(control, 'pid_wpt_kernel', fake, raising=False)
+    return fake
+
+
+def test_aot_kernel_selected_only_for_matching_version(monkeypatch):
+    fake = _fake_kernel_module(monkeypatch, pid_wpt_tracker.PID_KERNEL_VERSION)
+    assert pid_wpt_tracker._select_pid_step_kernel() is fake.pid_step
+    _fake_kernel_module(monkeypatch, pid_wpt_tracker.PID_KERNEL_VERSION - 1)
+    assert pid_wpt_tracker._select_pid_step_kernel() is pid_wpt_tracker._pid_step
+    monkeypatch.setitem(sys.modules, 'ISS.algorithms.control.pid_wpt_kernel', None)
+    import ISS.algorithms.control as control
+    monkeypatch.delattr(control, 'pid_wpt_kernel', raising=False)
+    assert pid_wpt_tracker._select_pid_step_kernel() is pid_wpt_tracker._pid_step
+
+
+def test_aot_kernel_matches_jit_kernel():
+    pid_wpt_kernel = pytest.importorskip('ISS.algorithms.control.pid_wpt_kernel')
+    if pid_wpt_kernel.version() != pid_wpt_tracker.PID_KERNEL_VERSION:
+        pytest.skip('pid_wpt_kernel was built for another PID_KERNEL_VERSION')
+    tracker = _make_tracker()
+    lon = tracker._lon_controller
+    lat = tracker._lat_controller
+    rng = np.random.default_rng(4)
+    for relocate in (True, False):
+        x, y, heading_angle, speed = rng.normal(size=4)
+        args = [tracker._traj_xy, tracker._traj_v, tracker._traj_len, 3, relocate, x, y,
+                math.cos(heading_angle), math.sin(heading_angle), speed, tracker._look_ahead, tracker._look_ahead_sq,
+                tracker._lost_track, tracker._lost_track_sq]
+        aot = pid_wpt_kernel.pid_step(*args, lon._error_buffer.copy(), lon._error_state, lon._gains,
+                                      lat._e_buffer.copy(), lat._e_state, lat._gains)
+        jit = pid_wpt_tracker._pid_step(*args, lon._error_buffer.copy(), lon._error_state, lon._gains,
+                                        lat._e_buffer.copy(), lat._e_state, lat._gains)
+        assert aot == jit
+
+
+def test_waypoint_advances_by_distance_only():
+    traj = np.array([[i * 0.1, 0.0, 0.0, 5.0] for i in range(200)])
+    tracker = VehiclePIDController(look_ahead=1.0)
+    tracker.set_traj(traj)
+
+    def check_carrot(x, y):
+        index = tracker.waypoint_index
+        assert math.hypot(traj[index, 0] - x, traj[index, 1] - y) > 1.0
+        assert math.hypot(traj[index - 1, 0] - x, traj[index - 1, 1] - y) <= 1.0
+
+    stationary = SimpleNamespace(x=0.0, y=0.05, heading_angle=0.0, velocity=0.0)
+    tracker.run_step(stationary)
+    index = tracker.waypoint_index
+    check_carrot(0.0, 0.05)
+    # a stationary vehicle keeps tracking the same waypoint instead of advancing one per step
+    for _ in range(5):
+        tracker.run_step(stationary)
+        assert tracker.waypoint_index == index
+
+    # a moving vehicle only advances past waypoints that fall inside the look-ahead radius
+    for step in range(1, 30):
+        x = step * 0.03
+        tracker.run_step(SimpleNamespace(x=x, y=0.05, heading_angle=0.0, velocity=1.0))
+        check_carrot(x, 0.05)
+        assert index <= tracker.waypoint_index <= index + 1
+        index = tracker.waypoint_index
@@ -1,7 +1,19 @@
+import os
+import sys
 from setuptools import setup, find_packages
 
+# compile the PID tracker kernel ahead of time when numba is installed,
+# see ISS/algorithms/control/pid_wpt_kernel_build.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from ISS.algorithms.control.pid_wpt_kernel_build import cc
+    ext_modules = [cc.distutils_extension()]
+except ImportError:
+    ext_modules = []
+
 setup(
     name='ISS',
     version='0.0',
     packages=find_packages(include=["ISS"]),
-)
\ No newline at end of file
+    ext_modules=ext_modules,
+)